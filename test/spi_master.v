@@ -0,0 +1,119 @@
+/*
+ * Copyright (c) 2024 Omar El-Sawy
+ * SPDX-License-Identifier: Apache-2.0
+ */
+
+`default_nettype none
+
+/* Testbench-only SPI master (mode 0) used by test.py.
+
+   test.py fills `queue` with 16-bit frames ({r_w, address[6:0], data[7:0]})
+   and pulses `start`. The first `count` frames are then shifted out MSB
+   first on COPI, toggling SCLK every HALF_PERIOD clk cycles and holding CS
+   high for `gap` clk cycles between frames. `done` pulses for one cycle
+   once the last frame has released CS, so the cocotb side only has to wait
+   on a single edge for the whole batch.
+*/
+module spi_master #(
+    parameter HALF_PERIOD = 50,  // clk cycles per SCLK half period (5 us at 10 MHz)
+    parameter DEPTH       = 32   // frames the queue can hold
+) (
+    input wire clk,
+    input wire rst_n,
+
+    input  wire        start,
+    input  wire [ 5:0] count,  // frames to send from queue[0]
+    input  wire [15:0] gap,    // CS-high clk cycles between frames
+    output reg         done,
+
+    output reg sclk,
+    output reg copi,
+    output reg cs_n
+);
+
+  // Written directly by test.py
+  reg [15:0] queue[0:DEPTH-1];
+
+  localparam IDLE = 2'd0, GAP = 2'd1, FRAME = 2'd2;
+  localparam [15:0] HALF_RELOAD = HALF_PERIOD - 1;
+
+  reg [ 1:0] state;
+  reg [ 5:0] index;
+  reg [15:0] shift_reg;
+  reg [ 4:0] bits_left;
+  reg [15:0] half_count;  // also counts the inter-frame gap
+
+  wire [15:0] next_frame = queue[index[$clog2(DEPTH)-1:0]];
+
+  always @(posedge clk or negedge rst_n) begin
+    if (!rst_n) begin
+      state      <= IDLE;
+      index      <= 6'd0;
+      shift_reg  <= 16'b0;
+      bits_left  <= 5'd0;
+      half_count <= 16'd0;
+      done       <= 1'b0;
+      sclk       <= 1'b0;
+      copi       <= 1'b0;
+      cs_n       <= 1'b1;
+    end else begin
+      done <= 1'b0;
+      case (state)
+        IDLE: begin
+          if (start && count != 0) begin
+            index      <= 6'd0;
+            half_count <= 16'd0;
+            state      <= GAP;
+          end
+        end
+
+        GAP: begin
+          if (half_count != 0) begin
+            half_count <= half_count - 16'd1;
+          end else begin
+            // Pull CS low with the first bit already on COPI
+            cs_n       <= 1'b0;
+            copi       <= next_frame[15];
+            shift_reg  <= {next_frame[14:0], 1'b0};
+            bits_left  <= 5'd16;
+            half_count <= HALF_RELOAD;
+            state      <= FRAME;
+          end
+        end
+
+        FRAME: begin
+          if (half_count != 0) begin
+            half_count <= half_count - 16'd1;
+          end else if (!sclk) begin
+            // SCLK high, keep COPI (the peripheral samples on this edge)
+            sclk       <= 1'b1;
+            half_count <= HALF_RELOAD;
+          end else if (bits_left == 5'd1) begin
+            // End transaction - return CS high
+            sclk <= 1'b0;
+            copi <= 1'b0;
+            cs_n <= 1'b1;
+            if (index == count - 6'd1) begin
+              done  <= 1'b1;
+              state <= IDLE;
+            end else begin
+              index      <= index + 6'd1;
+              half_count <= gap;
+              state      <= GAP;
+            end
+          end else begin
+            // SCLK low, set COPI
+            sclk       <= 1'b0;
+            copi       <= shift_reg[15];
+            shift_reg  <= {shift_reg[14:0], 1'b0};
+            bits_left  <= bits_left - 5'd1;
+            half_count <= HALF_RELOAD;
+          end
+        end
+
+        default: state <= IDLE;
+      endcase
+    end
+  end
+
+endmodule
@@ -6,11 +6,14 @@
 module tb ();
 
   // Dump the signals to a VCD file. You can view it with gtkwave or surfer.
+  // Off by default to keep regressions fast; build with COCOTB_DUMP_VCD=1.
+`ifdef COCOTB_DUMP_VCD
   initial begin
     $dumpfile("tb.vcd");
     $dumpvars(0, tb);
     #1;
   end
+`endif
 
   // Wire up the inputs and outputs:
   reg clk;
@@ -21,6 +24,56 @@ module tb ();
   wire [7:0] uo_out;
   wire [7:0] uio_out;
   wire [7:0] uio_oe;
+
+  // PWM channel 0 on its own net so the test can await its edges directly
+  wire pwm0 = uo_out[0];
+
+  // Output checker driven by test.py: while check_en is set, the bits of
+  // {uio_out, uo_out} selected by check_mask must equal check_expected on
+  // every clk edge (X/Z count as mismatches). The first mismatch is reported
+  // and latches check_error.
+  reg check_en;
+  reg [15:0] check_mask;
+  reg [15:0] check_expected;
+  reg check_error;
+
+  always @(posedge clk or negedge rst_n) begin
+    if (!rst_n) begin
+      check_error <= 1'b0;
+    end else if (check_en && (({uio_out, uo_out} & check_mask) !== check_expected)) begin
+      if (!check_error)
+        $display("%t: output check failed, {uio_out, uo_out} = %h, expected %h (mask %h)",
+                 $time, {uio_out, uo_out}, check_expected, check_mask);
+      check_error <= 1'b1;
+    end
+  end
+
+  // 10 MHz clock (100 ns period), generated here instead of by a cocotb Clock
+  initial clk = 1'b0;
+  always #50 clk = ~clk;
+
+  // HDL SPI master: test.py loads spi_master_inst.queue, sets spi_count and
+  // spi_gap, pulses spi_start and waits for spi_done.
+  // While it holds CS low it owns ui_in[2:0], otherwise ui_in passes through.
+  reg [5:0] spi_count;
+  reg [15:0] spi_gap;
+  reg spi_start;
+  wire spi_done;
+  wire spi_sclk, spi_copi, spi_cs_n;
+  wire [7:0] ui_in_spi = spi_cs_n ? ui_in : {ui_in[7:3], spi_cs_n, spi_copi, spi_sclk};
+
+  spi_master spi_master_inst (
+      .clk  (clk),
+      .rst_n(rst_n),
+      .start(spi_start),
+      .count(spi_count),
+      .gap  (spi_gap),
+      .done (spi_done),
+      .sclk (spi_sclk),
+      .copi (spi_copi),
+      .cs_n (spi_cs_n)
+  );
+
 `ifdef GL_TEST
   wire VPWR = 1'b1;
   wire VGND = 1'b0;
@@ -32,7 +85,7 @@ module tb ();
       .VGND(VGND),
 `endif
 
-      .ui_in  (ui_in),    // Dedicated inputs
+      .ui_in  (ui_in_spi),  // Dedicated inputs
       .uo_out (uo_out),   // Dedicated outputs
       .uio_in (uio_in),   // IOs: Input path
       .uio_out(uio_out),  // IOs: Output path
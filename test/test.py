@@ -1,46 +1,99 @@
 # SPDX-FileCopyrightText: © 2024 Tiny Tapeout
 # SPDX-License-Identifier: Apache-2.0
 
+import os
+
 import cocotb
-from cocotb.clock import Clock
-from cocotb.triggers import ClockCycles
-from cocotb.types import Logic, LogicArray
+from cocotb.triggers import ClockCycles, Edge, FallingEdge, RisingEdge, Timer, with_timeout
+from cocotb.types import LogicArray
 from cocotb.utils import get_sim_time
 
-async def detect_rising_edge(dut, signal, bit_index):
-    mask = 1 << bit_index
-    while (signal.value & mask):
-        await ClockCycles(dut.clk, 1)
-    while not (signal.value & mask):
-        await ClockCycles(dut.clk, 1)
+# Drive SPI from Python instead of the spi_master shim in tb.v
+SPI_BITBANG = os.environ.get("SPI_BITBANG", "0") != "0"
 
-async def detect_falling_edge(dut, signal, bit_index):
-    mask = 1 << bit_index
-    while not (signal.value & mask):
-        await ClockCycles(dut.clk, 1)
-    while (signal.value & mask):
-        await ClockCycles(dut.clk, 1)
+# tb.v toggles clk every 50 ns (10 MHz)
+CLK_PERIOD_NS = 100
 
-async def await_half_sclk(dut):
-    """Wait for the SCLK signal to go high or low."""
-    start_time = cocotb.utils.get_sim_time(units="ns")
-    while True:
-        await ClockCycles(dut.clk, 1)
-        # Wait for half of the SCLK period (10 us)
-        if (start_time + 100*100*0.5) < cocotb.utils.get_sim_time(units="ns"):
-            break
-    return
+# Half of the bit-banged SCLK period (10 us)
+SPI_HALF_SCLK_NS = 5000
+# Frames the spi_master queue in tb.v can hold (its DEPTH parameter)
+SPI_QUEUE_DEPTH = 32
+# CS-high clk cycles after each transaction. The peripheral commits the
+# register while SCLK is still high on the last bit, so this only needs to
+# cover its 4-flop CS synchroniser.
+SPI_IDLE_CYCLES = 10
+
+# clk cycles per PWM period: (clk_div_trig + 1) * 256 in pwm_peripheral.v
+PWM_PERIOD_CYCLES = 13 * 256
+# PWM periods averaged per frequency / duty cycle measurement
+PWM_PERIODS = 8
+
+# ui_in = {5'b0, ncs, copi, sclk}, precomputed so the SPI loop assigns plain ints
+UI_IDLE = 0b00000100
+# CS-low, SCLK-low ui_in value for each bit of a byte, MSB first; OR in 1 for SCLK high
+UI_SPI_BYTE = tuple(bytes(((byte >> (7-i)) & 0x1) << 1 for i in range(8)) for byte in range(256))
+
+async def delay_cycles(n):
+    """
+    Let n clk cycles pass with one Timer instead of n ClockCycles edges.
+
+    The wait is rounded to end a quarter period away from the clk toggles in
+    tb.v: Verilator (--timing) does not resume a Timer that expires on the
+    same step as an HDL delay.
+    """
+    phase = round(get_sim_time('ns')) % (CLK_PERIOD_NS // 2)
+    await Timer(n * CLK_PERIOD_NS + CLK_PERIOD_NS // 4 - phase, units="ns")
 
 def FloatComparison(value1: float, value2: float) -> float:
-    return abs(value1 - value2) / value1
+    """Relative difference of value2 from value1 (guarded against value1 == 0)."""
+    return abs(value1 - value2) / max(abs(value1), 1e-30)
 
-def ui_in_logicarray(ncs, bit, sclk):
-    """Setup the ui_in value as a LogicArray."""
-    return LogicArray(f"00000{ncs}{bit}{sclk}")
+async def reset_dut(dut):
+    """Enable the design, idle the SPI inputs and pulse rst_n."""
+    dut._log.info("Reset")
+    dut.ena.value = 1
+    dut.ui_in.value = UI_IDLE
+    dut.spi_start.value = 0
+    dut.check_en.value = 0
+    dut.rst_n.value = 0
+    await delay_cycles(5)
+    dut.rst_n.value = 1
+    await delay_cycles(5)
 
-async def send_spi_transaction(dut, r_w, address, data):
+def expect_outputs(dut, uo_out=None, uio_out=None):
+    """
+    Have tb.v check uo_out / uio_out against these values on every clk edge
+    from now on; None leaves that port unchecked. Mismatches latch
+    check_error, which check_outputs() asserts on.
+    """
+    mask = (0 if uo_out is None else 0x00FF) | (0 if uio_out is None else 0xFF00)
+    dut.check_mask.value = mask
+    dut.check_expected.value = ((uio_out or 0) << 8 | (uo_out or 0)) & mask
+    dut.check_en.value = int(mask != 0)
+
+def check_outputs(dut):
+    """Fail if the tb.v output checker has seen a mismatch."""
+    assert dut.check_error.value == 0, "Output check failed, see the simulator log"
+
+def spi_ui_sequence(frame):
+    """SCLK-low ui_in value for every bit of a 16-bit frame, MSB first."""
+    return UI_SPI_BYTE[frame >> 8] + UI_SPI_BYTE[frame & 0xFF]
+
+async def bitbang_spi_transaction(dut, frame):
+    """Drive one SPI frame edge by edge from Python (SPI_BITBANG=1)."""
+    ui_in = dut.ui_in
+    # CS goes low with the first bit; its first half period is the CS setup
+    for base in spi_ui_sequence(frame):
+        # SCLK low, set COPI
+        ui_in.value = base
+        await Timer(SPI_HALF_SCLK_NS, units="ns")
+        # SCLK high, keep COPI
+        ui_in.value = base | 1
+        await Timer(SPI_HALF_SCLK_NS, units="ns")
+
+def spi_frame(r_w, address, data):
     """
-    Send an SPI transaction with format:
+    Pack an SPI transaction into its 16-bit frame with format:
     - 1 bit for Read/Write
     - 7 bits for address
     - 8 bits for data
@@ -62,152 +115,133 @@ async def send_spi_transaction(dut, r_w, address, data):
         raise ValueError("Data must be 8-bit (0-255)")
     # Combine RW and address into first byte
     first_byte = (int(r_w) << 7) | address
-    # Start transaction - pull CS low
-    sclk = 0
-    ncs = 0
-    bit = 0
-    # Set initial state with CS low
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    await ClockCycles(dut.clk, 1)
-    # Send first byte (RW + Address)
-    for i in range(8):
-        bit = (first_byte >> (7-i)) & 0x1
-        # SCLK low, set COPI
-        sclk = 0
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-        # SCLK high, keep COPI
-        sclk = 1
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-    # Send second byte (Data)
-    for i in range(8):
-        bit = (data_int >> (7-i)) & 0x1
-        # SCLK low, set COPI
-        sclk = 0
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-        # SCLK high, keep COPI
-        sclk = 1
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
+    return (first_byte << 8) | data_int
+
+async def send_spi_batch(dut, transactions, gap_cycles=0):
+    """
+    Send a list of (r_w, address, data) SPI transactions back to back.
+
+    The frames are loaded into the spi_master queue in tb.v, which plays
+    them out with gap_cycles of extra CS-high idle between them, so Python
+    only wakes up once for the whole batch. Set SPI_BITBANG=1 to drive
+    them from Python instead.
+    """
+    frames = [spi_frame(r_w, address, data) for r_w, address, data in transactions]
+    if not 0 < len(frames) <= SPI_QUEUE_DEPTH:
+        raise ValueError(f"Batch must hold 1-{SPI_QUEUE_DEPTH} transactions")
+    ui_in = dut.ui_in
+    if SPI_BITBANG:
+        for i, frame in enumerate(frames):
+            if i:
+                ui_in.value = UI_IDLE
+                await delay_cycles(SPI_IDLE_CYCLES + gap_cycles)
+            await bitbang_spi_transaction(dut, frame)
+    else:
+        # Hand the whole batch to the HDL master and wait for it to finish
+        queue = dut.spi_master_inst.queue
+        for i, frame in enumerate(frames):
+            queue[i].value = frame
+        dut.spi_count.value = len(frames)
+        dut.spi_gap.value = SPI_IDLE_CYCLES + gap_cycles
+        dut.spi_start.value = 1
+        await ClockCycles(dut.clk, 1)
+        dut.spi_start.value = 0
+        await RisingEdge(dut.spi_done)
     # End transaction - return CS high
-    sclk = 0
-    ncs = 1
-    bit = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    await ClockCycles(dut.clk, 600)
-    return ui_in_logicarray(ncs, bit, sclk)
+    ui_in.value = UI_IDLE
+    await delay_cycles(SPI_IDLE_CYCLES)
+
+async def send_spi_transaction(dut, r_w, address, data):
+    """Send a single SPI transaction; see spi_frame for the format."""
+    await send_spi_batch(dut, [(r_w, address, data)])
 
 @cocotb.test()
 async def test_spi(dut):
     dut._log.info("Start SPI test")
 
-    # Set the clock period to 100 ns (10 MHz)
-    clock = Clock(dut.clk, 100, units="ns")
-    cocotb.start_soon(clock.start())
-
-    # Reset
-    dut._log.info("Reset")
-    dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
+    await reset_dut(dut)
+    uo_out = dut.uo_out
 
     dut._log.info("Test project behavior")
     dut._log.info("Write transaction, address 0x00, data 0xF0")
     await send_spi_transaction(dut, 1, 0x00, 0xF0)  # Write transaction
-    assert dut.uo_out.value == 0xF0, f"Expected 0xF0, got {dut.uo_out.value}"
-    await ClockCycles(dut.clk, 1000) 
+    expect_outputs(dut, uo_out=0xF0)
+    await delay_cycles(1000) 
 
     dut._log.info("Write transaction, address 0x01, data 0xCC")
     await send_spi_transaction(dut, 1, 0x01, 0xCC)  # Write transaction
-    assert dut.uio_out.value == 0xCC, f"Expected 0xCC, got {dut.uio_out.value}"
-    await ClockCycles(dut.clk, 100)
+    expect_outputs(dut, uo_out=0xF0, uio_out=0xCC)
+    await delay_cycles(100)
 
+    # Invalid transactions must leave the outputs alone
     dut._log.info("Write transaction, address 0x30 (invalid), data 0xAA")
-    await send_spi_transaction(dut, 1, 0x30, 0xAA)
-    await ClockCycles(dut.clk, 100)
-
-    dut._log.info("Read transaction (invalid), address 0x00, data 0xBE")
-    await send_spi_transaction(dut, 0, 0x30, 0xBE)
-    assert dut.uo_out.value == 0xF0, f"Expected 0xF0, got {dut.uo_out.value}"
-    await ClockCycles(dut.clk, 100)
-    
+    dut._log.info("Read transaction (invalid), address 0x30, data 0xBE")
     dut._log.info("Read transaction (invalid), address 0x41 (invalid), data 0xEF")
-    await send_spi_transaction(dut, 0, 0x41, 0xEF)
-    await ClockCycles(dut.clk, 100)
-
-    dut._log.info("Write transaction, address 0x02, data 0xFF")
-    await send_spi_transaction(dut, 1, 0x02, 0xFF)  # Write transaction
-    await ClockCycles(dut.clk, 100)
-
-    dut._log.info("Write transaction, address 0x04, data 0xCF")
-    await send_spi_transaction(dut, 1, 0x04, 0xCF)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
-
-    dut._log.info("Write transaction, address 0x04, data 0xFF")
-    await send_spi_transaction(dut, 1, 0x04, 0xFF)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
-
-    dut._log.info("Write transaction, address 0x04, data 0x00")
-    await send_spi_transaction(dut, 1, 0x04, 0x00)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
-
-    dut._log.info("Write transaction, address 0x04, data 0x01")
-    await send_spi_transaction(dut, 1, 0x04, 0x01)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
-
+    await send_spi_batch(dut, [(1, 0x30, 0xAA), (0, 0x30, 0xBE), (0, 0x41, 0xEF)], gap_cycles=100)
+    await delay_cycles(100)
+    check_outputs(dut)
+
+    # Known spi_peripheral bug: it has no read path, and a read leaves it in
+    # COMPLETE, ignoring every write until reset. Pin that down so a fix in
+    # src/spi_peripheral.v shows up here, then restart from a fresh reset.
+    dut._log.info("Write transaction after a read (ignored), address 0x00, data 0x0F")
+    await send_spi_transaction(dut, 1, 0x00, 0x0F)  # Write transaction
+    await delay_cycles(100)
+    check_outputs(dut)
+
+    await reset_dut(dut)
+    dut._log.info("Write transactions, address 0x00, 0x01, 0x02, data 0xF0, 0xCC, 0xFF")
+    await send_spi_batch(dut, [(1, 0x00, 0xF0), (1, 0x01, 0xCC), (1, 0x02, 0xFF)], gap_cycles=100)
+    # 0x02 hands uo_out over to the PWM
+    expect_outputs(dut, uio_out=0xCC)
+    await delay_cycles(100)
+
+    # uo_out[7:4] now follow the PWM: 0xFF / 0x00 hold them high / low for a
+    # whole PWM period, any other duty has to toggle them within one
+    for duty, expected in ((0xCF, None), (0xFF, 0xF0), (0x00, 0x00), (0x01, None)):
+        dut._log.info(f"Write transaction, address 0x04, data {duty:#04x}")
+        await send_spi_transaction(dut, 1, 0x04, duty)  # Write transaction
+        if expected is None:
+            await with_timeout(Edge(uo_out), PWM_PERIOD_CYCLES * CLK_PERIOD_NS, "ns")
+        else:
+            expect_outputs(dut, uo_out=expected, uio_out=0xCC)
+            await delay_cycles(PWM_PERIOD_CYCLES)
+            expect_outputs(dut, uio_out=0xCC)
+
+    check_outputs(dut)
     dut._log.info("SPI test completed successfully")
 
 @cocotb.test()
 async def test_pwm_freq(dut):
     dut._log.info("Start PWM Freq test")
 
-    # Set the clock period to 100 ns (10 MHz)
-    clock = Clock(dut.clk, 100, units="ns")
-    cocotb.start_soon(clock.start())
-
-    # Reset
-    dut._log.info("Reset")
-    dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
+    await reset_dut(dut)
 
     # en_reg_pwm_7_0 to get access to out[0]
     dut._log.info("Write transaction, address 0x02, data 0x01")
     await send_spi_transaction(dut, 1, 0x02, 0x01)  # Write transaction
-    await ClockCycles(dut.clk, 1000)
+    await delay_cycles(1000)
     await send_spi_transaction(dut, 1, 0x00, 0x01)  # Write transaction
-    await ClockCycles(dut.clk, 1000)
+    await delay_cycles(1000)
 
     test_values = [0x0F, 0xD1]
     for test_v in test_values:
         dut._log.info(f"Write transaction, address 0x04, data {test_v}")
         await send_spi_transaction(dut, 1, 0x04, test_v)  # Write transaction
-        await ClockCycles(dut.clk, 1000)
+        await delay_cycles(200)
 
-        await detect_rising_edge(dut, dut.uo_out, 0)
+        # Average over several periods
+        await RisingEdge(dut.pwm0)
         start_time = get_sim_time('ns')
-        await detect_rising_edge(dut, dut.uo_out, 0)
+        for _ in range(PWM_PERIODS):
+            await RisingEdge(dut.pwm0)
         end_time = get_sim_time('ns')
 
-        measured_period = end_time - start_time 
-        measured_freq = (1 / measured_period)
+        measured_period = (end_time - start_time) / PWM_PERIODS
+        measured_freq = 1e9 / measured_period  # period is in ns, freq in Hz
 
         dut._log.info(f"{measured_freq}\n")
-        assert FloatComparison(measured_freq, 3000), f"Measured Freq: {measured_freq}\nActual Frequency: 3000\n"
+        assert FloatComparison(measured_freq, 3000) < 0.10, f"Measured Freq: {measured_freq}\nActual Frequency: 3000\n"
 
     dut._log.info("PWM Frequency test completed successfully")
 
@@ -216,46 +250,35 @@ async def test_pwm_freq(dut):
 async def test_pwm_duty(dut):
     dut._log.info("Start PWM Duty test")
 
-    # Set the clock period to 100 ns (10 MHz)
-    clock = Clock(dut.clk, 100, units="ns")
-    cocotb.start_soon(clock.start())
-
-    # Reset
-    dut._log.info("Reset")
-    dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
+    await reset_dut(dut)
 
     # en_reg_pwm_7_0 to get access to out[0]
     dut._log.info("Write transaction, address 0x02, data 0x01")
     await send_spi_transaction(dut, 1, 0x02, 0x01)  # Write transaction
-    await ClockCycles(dut.clk, 1000)
+    await delay_cycles(1000)
     await send_spi_transaction(dut, 1, 0x00, 0x01)  # Write transaction
-    await ClockCycles(dut.clk, 1000)
+    await delay_cycles(1000)
 
     test_values = [0x0F, 0xD1]
     for test_v in test_values:
         dut._log.info("Write transaction, address 0x04, data custom")
         await send_spi_transaction(dut, 1, 0x04, test_v)  # Write transaction
-        await ClockCycles(dut.clk, 1000)
+        await delay_cycles(200)
 
         ########################################
         # Track PWM
         ########################################
-        await detect_rising_edge(dut, dut.uo_out, 0)
+        await RisingEdge(dut.pwm0)
         period_start = get_sim_time('ns')
-        await detect_falling_edge(dut, dut.uo_out, 0)
-        fall_time = get_sim_time('ns')
-        await detect_rising_edge(dut, dut.uo_out, 0)
+        high_time = 0
+        for _ in range(PWM_PERIODS):
+            rise_time = get_sim_time('ns')
+            await FallingEdge(dut.pwm0)
+            high_time += get_sim_time('ns') - rise_time
+            await RisingEdge(dut.pwm0)
         period_end = get_sim_time('ns')
 
-        measured_duty_cycle: float = (fall_time - period_start) / (period_end - period_start)
+        measured_duty_cycle: float = high_time / (period_end - period_start)
         estimated_duty_cycle: float = (test_v / 0xFF)
         dut._log.info(f"{measured_duty_cycle}\n")
         assert FloatComparison(measured_duty_cycle, estimated_duty_cycle) < 0.10, f"Measured Duty Cycle: {measured_duty_cycle}\nEstimated Duty Cycle: {estimated_duty_cycle}"